@@ -1,76 +1,162 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-import plotly.express as px
+import plotly.graph_objects as go
+from sqlalchemy import create_engine, text
 from db_config import get_connection  # External DB config
 
-def fetch_category_data(start_date, end_date):
-    conn = get_connection()
-    query = f"""
+# --- Fixed result dtypes (cast after read, so cached frames keep one schema) ---
+METRIC_DTYPES = {
+    "total_earnings": "float64[pyarrow]",
+    "avg_earnings": "float64[pyarrow]",
+    "total_impressions": "int64[pyarrow]",
+    "EPI": "float64[pyarrow]",
+    "CTR": "float64[pyarrow]",
+}
+
+# --- Low-cardinality labels stored as int codes + a small dictionary ---
+LABEL_COLUMNS = ["category", "Conceptual_Group", "partner"]
+
+# --- SQL statements, built once and bound per call ---
+STMT_CATEGORY = text("""
+    SELECT Conceptual_Group, category,
+           SUM(est_earnings) AS total_earnings,
+           AVG(est_earnings) AS avg_earnings,
+           SUM(uniq_impr) AS total_impressions,
+           SUM(est_earnings)/NULLIF(SUM(uniq_impr), 0) AS EPI,
+           SUM(paid_clicks)/NULLIF(SUM(uniq_impr), 0) AS CTR
+    FROM team_block_stats
+    WHERE eventDate BETWEEN :start AND :end
+      AND est_earnings > 0
+      AND category IS NOT NULL
+      AND LOWER(category) <> 'none'
+    GROUP BY category, Conceptual_Group
+    ORDER BY total_earnings DESC
+""")
+
+STMT_PARTNER_LIST = text("""
+    SELECT DISTINCT partner
+    FROM team_block_stats
+    WHERE eventDate BETWEEN :start AND :end
+      AND est_earnings > 0
+      AND partner IS NOT NULL
+""")
+
+STMT_PARTNER_STATS = text("""
+    SELECT category, Conceptual_Group,
+           SUM(est_earnings) AS total_earnings
+    FROM team_block_stats
+    WHERE eventDate BETWEEN :start AND :end
+      AND partner = :partner
+      AND est_earnings > 0
+    GROUP BY category, Conceptual_Group
+""")
+
+STMT_RECOMMENDATIONS = text("""
+    WITH agg AS (
         SELECT Conceptual_Group, category,
                SUM(est_earnings) AS total_earnings,
                AVG(est_earnings) AS avg_earnings,
                SUM(uniq_impr) AS total_impressions,
                SUM(est_earnings)/NULLIF(SUM(uniq_impr), 0) AS EPI,
-               SUM(paid_clicks)/NULLIF(SUM(uniq_impr), 0) AS CTR
+               SUM(paid_clicks)/NULLIF(SUM(uniq_impr), 0) AS CTR,
+               ROW_NUMBER() OVER (ORDER BY SUM(est_earnings) DESC) AS rn
         FROM team_block_stats
-        WHERE eventDate BETWEEN '{start_date}' AND '{end_date}'
+        WHERE eventDate BETWEEN :start AND :end
           AND est_earnings > 0
+          AND category IS NOT NULL
+          AND LOWER(category) <> 'none'
         GROUP BY category, Conceptual_Group
-        ORDER BY total_earnings DESC
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df
-
-
-# --- Fetch all category-partner mapping ---
-def fetch_raw_data(start_date, end_date):
-    conn = get_connection()
-    query = f"""
-        SELECT DISTINCT category, partner
+    ),
+    partner_used AS (
+        SELECT DISTINCT category
         FROM team_block_stats
-        WHERE eventDate BETWEEN '{start_date}' AND '{end_date}'
+        WHERE eventDate BETWEEN :start AND :end
+          AND partner = :partner
           AND est_earnings > 0
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
+          AND category IS NOT NULL
+    )
+    SELECT Conceptual_Group, category, total_earnings, avg_earnings,
+           total_impressions, EPI, CTR
+    FROM agg
+    WHERE rn <= 30
+      AND category NOT IN (SELECT category FROM partner_used)
+    ORDER BY total_earnings DESC
+""")
+
+
+# --- Pool DB connections across reruns and sessions ---
+@st.cache_resource
+def get_engine():
+    # Connections still come from db_config; the pool checks them out per query
+    return create_engine("mysql+mysqlconnector://", creator=get_connection,
+                         pool_size=4, pool_pre_ping=True)
+
+
+# --- Run a bound statement into an Arrow-backed DataFrame ---
+def read_query(query, params, dtype=None):
+    engine = get_engine()
+    df = pd.read_sql_query(query, engine, params=params, dtype=dtype, dtype_backend="pyarrow")
+    label_cols = [col for col in LABEL_COLUMNS if col in df.columns]
+    return df.astype(dict.fromkeys(label_cols, "category"))
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_category_data(start_date, end_date):
+    df = read_query(STMT_CATEGORY, {"start": start_date, "end": end_date},
+                    dtype=METRIC_DTYPES)
     return df
 
 
-# --- Fetch category earnings for selected partner ---
-def fetch_partner_category_data(start_date, end_date, partner):
-    conn = get_connection()
-    query = f"""
-        SELECT category,
-               SUM(est_earnings) AS total_earnings
-        FROM team_block_stats
-        WHERE eventDate BETWEEN '{start_date}' AND '{end_date}'
-          AND partner = '{partner}'
-          AND est_earnings > 0
-          AND category IS NOT NULL
-        GROUP BY category
-        HAVING SUM(est_earnings) > 0
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
+# --- Fetch partners active in the date range ---
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_partner_list(start_date, end_date):
+    df = read_query(STMT_PARTNER_LIST, {"start": start_date, "end": end_date})
+    # astype("category") builds the categories as the sorted distinct values
+    return df["partner"].cat.categories.tolist()
+
+
+# --- Fetch selected partner's earnings per category and Conceptual_Group ---
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_partner_stats(start_date, end_date, partner):
+    df = read_query(STMT_PARTNER_STATS, {"start": start_date, "end": end_date, "partner": partner},
+                    dtype={"total_earnings": METRIC_DTYPES["total_earnings"]})
+    partner_used_df = (
+        df.groupby("category", as_index=False, observed=True)["total_earnings"].sum()
+        .sort_values("total_earnings", ascending=False)
+    )
+    in_domain_groups = df["Conceptual_Group"].dropna().unique().tolist()
+    return partner_used_df, in_domain_groups
+
+
+# --- Fetch top categories the selected partner doesn't use yet ---
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_recommendations(start_date, end_date, partner):
+    df = read_query(STMT_RECOMMENDATIONS, {"start": start_date, "end": end_date, "partner": partner},
+                    dtype=METRIC_DTYPES)
     return df
 
 
-# --- Fetch partner's Conceptual_Groups ---
-def fetch_partner_conceptual_groups(start_date, end_date, partner):
-    conn = get_connection()
-    query = f"""
-        SELECT DISTINCT Conceptual_Group
-        FROM team_block_stats
-        WHERE eventDate BETWEEN '{start_date}' AND '{end_date}'
-          AND partner = '{partner}'
-          AND est_earnings > 0
-          AND Conceptual_Group IS NOT NULL
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df["Conceptual_Group"].dropna().unique().tolist()
+# --- Build a bar chart with graph_objects (skips plotly.express introspection) ---
+def build_bar_chart(df, y_col, title, y_label, color_scale, hover_cols):
+    y = df[y_col].to_numpy(dtype="float64", na_value=np.nan)
+    hover_lines = "".join(f"<br>{col}=%{{customdata[{i}]}}" for i, col in enumerate(hover_cols))
+    fig = go.Figure(go.Bar(
+        x=df["category"].to_numpy(dtype=object),
+        y=y,
+        marker=dict(color=y, colorscale=color_scale, showscale=True, colorbar=dict(title=y_label)),
+        customdata=df[list(hover_cols)].to_numpy(dtype=object, na_value=None),
+        hovertemplate=f"category=%{{x}}<br>{y_label}=%{{y}}{hover_lines}<extra></extra>",
+    ))
+    fig.update_layout(title=title, xaxis_title="category", yaxis_title=y_label)
+    return fig
+
+
+# --- Serialize download payloads once per DataFrame ---
+@st.cache_data(ttl=600, max_entries=32, show_spinner=False)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode()
 
 
 # --- Streamlit App ---
@@ -89,40 +175,36 @@ if start_date > end_date:
     st.sidebar.error("⚠️ Start date cannot be after end date.")
     st.stop()
 
+# --- ISO strings keep the cache keys cheap to hash ---
+start_iso = start_date.isoformat()
+end_iso = end_date.isoformat()
+
 # --- Load data with spinner ---
 with st.spinner("Fetching data..."):
-    category_df = fetch_category_data(start_date, end_date)
-    raw_df = fetch_raw_data(start_date, end_date)
+    category_df = fetch_category_data(start_iso, end_iso)
+    partner_list = fetch_partner_list(start_iso, end_iso)
 
 if category_df.empty:
     st.warning("No data available for the selected date range.")
     st.stop()
 
 # --- Partner dropdown ---
-partner_list = sorted(raw_df["partner"].dropna().unique().tolist())
 selected_partner = st.sidebar.selectbox("🤝 Select Partner", partner_list)
 
-# --- Clean category_df ---
-category_df = category_df.dropna(subset=["category", "total_earnings"])
-category_df = category_df[category_df["category"].str.lower() != "none"]
-
 # --- Summary Metrics ---
 # st.subheader("📌 Summary")
+totals = category_df[["total_earnings", "total_impressions"]].sum()
 col1, col2, col3 = st.columns(3)
-col1.metric("Total Earnings", f"${category_df['total_earnings'].sum():,.2f}")
-col2.metric("Total Impressions", f"{int(category_df['total_impressions'].sum()):,}")
-col3.metric("Partners", f"{raw_df['partner'].nunique():,}")
+col1.metric("Total Earnings", f"${totals['total_earnings']:,.2f}")
+col2.metric("Total Impressions", f"{int(totals['total_impressions']):,}")
+col3.metric("Partners", f"{len(partner_list):,}")
 
 # --- Tabs for better UI ---
 tab1, tab2, tab3 = st.tabs(["📂 Overall Categories", "🧠 Recommendations", f"📈 {selected_partner}'s Usage"])
 
-with tab1:
-    st.subheader("📂 Category-Level Performance")
-    # Round all numeric columns to 2 decimal places
-    category_df = category_df.round(2)
-    st.dataframe(category_df.reset_index(drop=True), use_container_width=True, hide_index=True)
-    st.download_button("📥 Download Full Category Data", category_df.to_csv(index=False), "category_performance.csv")
-
+# --- Top categories chart (fragment: the radio reruns only this block, not the SQL) ---
+@st.fragment
+def render_top_categories(display_df):
     # --- Toggle for chart metric ---
     metric_choice = st.radio(
         "Select metric for Top 15 Categories:",
@@ -135,37 +217,37 @@ with tab1:
     chart_title = f"Top 15 Categories by {metric_choice}"
 
     # --- Visualization: Top 15 Categories ---
-    top15 = category_df.sort_values(y_col, ascending=False).head(20)
-    fig_top = px.bar(
-        top15,
-        x="category",
-        y=y_col,
-        color=y_col,
-        color_continuous_scale="blues",
-        title=chart_title,
-        hover_data=["Conceptual_Group", "avg_earnings", "total_earnings", "EPI", "CTR"]
+    top15 = display_df.nlargest(15, y_col)
+    fig_top = build_bar_chart(
+        top15, y_col, chart_title, y_col, "blues",
+        ("Conceptual_Group", "avg_earnings", "total_earnings", "EPI", "CTR")
     )
     st.plotly_chart(fig_top, use_container_width=True)
 
-# --- Fetch partner category and conceptual group data ---
-partner_used_df = fetch_partner_category_data(start_date, end_date, selected_partner)
-partner_categories = partner_used_df["category"].tolist()
-in_domain_groups = fetch_partner_conceptual_groups(start_date, end_date, selected_partner)
 
-# --- Recommendations ---
-top_categories = category_df.sort_values("total_earnings", ascending=False).head(30)["category"].tolist()
-recommended = [cat for cat in top_categories if cat not in partner_categories]
-recommended_df = category_df[category_df["category"].isin(recommended)]
-recommended_df["Domain"] = recommended_df["Conceptual_Group"].apply(
-    lambda x: "In-Domain" if x in in_domain_groups else "Out-of-Domain"
-)
+with tab1:
+    st.subheader("📂 Category-Level Performance")
+    # Round all numeric columns to 2 decimal places (the one display copy)
+    display_df = category_df.round(2)
+    st.dataframe(display_df, use_container_width=True, hide_index=True)
+    st.download_button("📥 Download Full Category Data", to_csv_bytes(display_df), "category_performance.csv")
+    render_top_categories(display_df)
+
+# --- Recommendations (fragment: partner data is only fetched and drawn here) ---
+@st.fragment
+def render_recommendations(start_date, end_date, partner):
+    _, in_domain_groups = fetch_partner_stats(start_date, end_date, partner)
+    recommended_df = fetch_recommendations(start_date, end_date, partner).round(2)
+    in_domain_set = set(in_domain_groups)
+    recommended_df = recommended_df.assign(
+        Domain=np.where(recommended_df["Conceptual_Group"].isin(in_domain_set), "In-Domain", "Out-of-Domain")
+    )
 
-with tab2:
     st.subheader("🧠 Recommended Categories for Partner (Domain-Aware)")
     if not recommended_df.empty:
         st.dataframe(recommended_df[["Conceptual_Group", "category", "total_earnings", "avg_earnings", "Domain"]],
                      use_container_width=True)
-        st.download_button("📥 Download Recommendations", recommended_df.to_csv(index=False), "recommendations.csv")
+        st.download_button("📥 Download Recommendations", to_csv_bytes(recommended_df), "recommendations.csv")
 
         # --- Toggle for recommendation charts ---
         rec_metric_choice = st.radio(
@@ -180,45 +262,55 @@ with tab2:
         # --- Visuals split by domain ---
         for domain_type in ["In-Domain", "Out-of-Domain"]:
             domain_df = recommended_df[recommended_df["Domain"] == domain_type]
+            # Rows already arrive ordered by total_earnings from SQL
+            if rec_y_col != "total_earnings":
+                domain_df = domain_df.sort_values(rec_y_col, ascending=False)
             if not domain_df.empty:
-                fig = px.bar(
-                    domain_df.sort_values(rec_y_col, ascending=False),
-                    x="category", y=rec_y_col,
-                    title=f"{domain_type} Category {rec_metric_choice}",
-                    labels={rec_y_col: rec_metric_choice},
-                    color=rec_y_col,
-                    color_continuous_scale="greens" if domain_type == "In-Domain" else "reds",
-                    hover_data=["Conceptual_Group", "total_earnings", "avg_earnings"]
+                fig = build_bar_chart(
+                    domain_df,
+                    rec_y_col,
+                    f"{domain_type} Category {rec_metric_choice}",
+                    rec_metric_choice,
+                    "greens" if domain_type == "In-Domain" else "reds",
+                    ("Conceptual_Group", "total_earnings", "avg_earnings")
                 )
                 st.plotly_chart(fig, use_container_width=True)
     else:
-        st.info(f"✅ Partner **{selected_partner}** already uses all top categories.")
+        st.info(f"✅ Partner **{partner}** already uses all top categories.")
 
 
-# --- Partner Usage ---
-with tab3:
+with tab2:
+    render_recommendations(start_iso, end_iso, selected_partner)
+
+
+# --- Partner Usage (fragment: shares the cached partner fetch with tab2) ---
+@st.fragment
+def render_partner_usage(start_date, end_date, partner):
+    partner_used_df, in_domain_groups = fetch_partner_stats(start_date, end_date, partner)
 
     # --- In-Domain Conceptual Groups Summary Table ---
     st.markdown("### ✅ Partner's In-Domain Conceptual Groups")
     if in_domain_groups:
         in_domain_data = pd.DataFrame({
-            "Partner": [selected_partner],
+            "Partner": [partner],
             "Conceptual_Groups": [", ".join(in_domain_groups)]
         })
         st.table(in_domain_data)
     else:
-        st.warning(f"No Conceptual Groups found for partner {selected_partner} in the selected date range.")
+        st.warning(f"No Conceptual Groups found for partner {partner} in the selected date range.")
 
     # --- Partner usage chart ---
     if not partner_used_df.empty:
-        fig2 = px.bar(partner_used_df.sort_values("total_earnings", ascending=False),
-                      x="category", y="total_earnings",
-                      title=f"📂 Earnings from Categories Used by {selected_partner}",
-                      labels={"total_earnings": "Total Earnings"},
-                      color="total_earnings", color_continuous_scale="purples",
-                      hover_data=["total_earnings"])
+        fig2 = build_bar_chart(partner_used_df,
+                               "total_earnings",
+                               f"📂 Earnings from Categories Used by {partner}",
+                               "Total Earnings", "purples", ())
         st.plotly_chart(fig2, use_container_width=True)
 
-        st.download_button("📥 Download Partner Data", partner_used_df.to_csv(index=False), f"{selected_partner}_usage.csv")
+        st.download_button("📥 Download Partner Data", to_csv_bytes(partner_used_df), f"{partner}_usage.csv")
     else:
-        st.warning(f"No categories found for partner {selected_partner} in the selected date range.")
+        st.warning(f"No categories found for partner {partner} in the selected date range.")
+
+
+with tab3:
+    render_partner_usage(start_iso, end_iso, selected_partner)